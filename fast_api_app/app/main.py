@@ -1,33 +1,50 @@
-from io import BytesIO
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-import aioredis
+import redis.asyncio as aioredis
 from contextlib import asynccontextmanager
 from fastapi_limiter import FastAPILimiter
-from fastapi.responses import StreamingResponse
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import ORJSONResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.utils import is_body_allowed_for_status_code
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 
 from fast_api_project import logger
-from fast_api_project.utils.validators import (
-    prompt_validator_dependency,
-    image_validator_dependency,
-)
+from fast_api_project.utils.validators import inputs_validator_dependency
 from fast_api_project.utils.forms import (
     num_inference_steps_form,
     image_guidance_scale_form,
+    image_format_query,
 )
 from fast_api_project.utils.common import pil_image_to_bytes
-from fast_api_project.fast_api_handler import FastAPIHandler
+from fast_api_project.utils.cache import (
+    make_cache_key,
+    get_cached_image,
+    set_cached_image,
+)
+from fast_api_project.fast_api_handler import (
+    FastAPIHandler,
+    HandlerDependency,
+)
 from fast_api_project.settings import (
+    AllowedResponseImageFormats,
     ImageSettings,
     ModelSettings,
+    RedisSettings,
+    CacheSettingsDependency,
+    ImageSettingsDependency,
     get_image_settings,
     get_model_settings,
+    get_redis_settings,
+)
+from fast_api_project.utils.limiters import (
+    global_limiter,
+    ip_limiter,
+    local_ip_limiter,
 )
-from fast_api_project.utils.limiters import global_limiter, ip_limiter
-
-
-# Empty variable to store the handler
-handler = None
 
 
 @asynccontextmanager
@@ -35,24 +52,31 @@ async def lifespan(
     app: FastAPI,
     image_settings: ImageSettings = get_image_settings(),
     model_settings: ModelSettings = get_model_settings(),
+    redis_settings: RedisSettings = get_redis_settings(),
 ):
     """
     This function is an asynchronous lifespan event handler for the
     FastAPI application.
 
-    It initializes a Redis client and passes it to the FastAPILimiter
+    It initializes a Redis client backed by a bounded connection pool,
+    stores it in `app.state` to cache the transformed images and
+    passes it to the FastAPILimiter
     to set up rate limiting for the application. The
     `FastAPILimiter.init()` function is called withx the Redis client
     to initialize the rate limiting functionality for the
     FastAPIapplication.
 
+    It sizes the default executor, used to decode and encode the
+    images, to the number of CPU cores.
+
     It also initializes the FastAPIHandler with the configuration
     settings provided in the corresponding objects. The
     `FastAPIHandler.setup()` function is called to initialize the
     handler.
 
     Finally, in any case, the handler is closed using the
-    `FastAPIHandler.close()` function.
+    `FastAPIHandler.close()` function and the Redis connection pool is
+    closed.
 
     Args:
         app (FastAPI):
@@ -61,21 +85,36 @@ async def lifespan(
             Image settings.
         prompt_settings (PromptSettings):
             Prompt settings.
+        redis_settings (RedisSettings):
+            Redis settings.
 
     Raises:
         HTTPException:
             If there is an error during the setup of the application.
     """
-    global handler
+    handler = None
+    redis_client = None
     try:
-        # Initialising the Redis client
-        redis_client = aioredis.from_url(
-            "redis://redis:6379", encoding="utf-8", decode_responses=True
+        # Sizing the default executor, which decodes and encodes the
+        # images, to the number of CPU cores
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=os.cpu_count())
+        )
+        # Initialising the Redis client with a shared connection pool.
+        # The responses are not decoded since the cached images are
+        # stored as raw bytes
+        redis_pool = aioredis.ConnectionPool.from_url(
+            redis_settings.url,
+            max_connections=redis_settings.max_connections,
+            decode_responses=False,
         )
+        redis_client = aioredis.Redis(connection_pool=redis_pool)
+        app.state.redis_client = redis_client
         await FastAPILimiter.init(redis_client)
         # Initialising the FastAPIHandler
         handler = FastAPIHandler(image_settings, model_settings)
         await handler.setup()
+        app.state.handler = handler
         logger.info("FastAPIHandler initialized successfully")
         yield
     except aioredis.RedisError as e:
@@ -90,46 +129,164 @@ async def lifespan(
         # Closing the FastAPIHandler
         if handler:
             await handler.close()
+        # Closing the Redis connection pool
+        if redis_client:
+            await redis_client.aclose()
+            await redis_pool.aclose()
+
+
+# Allowance for the prompt and the multipart encoding on top of the
+# maximum image file size when checking the size of the request body
+_MAX_BODY_OVERHEAD = 65536
 
 
 # Initialisation of the FastAPI app
 app = FastAPI(
     lifespan=lifespan,
-    dependencies=[Depends(global_limiter), Depends(ip_limiter)],
+    default_response_class=ORJSONResponse,
+    # The local pre-check goes first, so that the requests of an IP
+    # address which is already throttled neither reach Redis nor use
+    # up the global limit
+    dependencies=[
+        Depends(local_ip_limiter),
+        Depends(global_limiter),
+        Depends(ip_limiter),
+    ],
 )
 
 
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(
+    request: Request, exc: StarletteHTTPException
+) -> Response:
+    """
+    Returns the error response of an HTTPException serialized with
+    orjson instead of the standard library json encoder used by the
+    default handler.
+
+    Args:
+        request (Request):
+            The incoming request object.
+        exc (StarletteHTTPException):
+            The raised exception.
+
+    Returns:
+        Response:
+            The error response
+    """
+    headers = getattr(exc, "headers", None)
+    if not is_body_allowed_for_status_code(exc.status_code):
+        return Response(status_code=exc.status_code, headers=headers)
+    return ORJSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers=headers,
+    )
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(
+    request: Request, exc: RequestValidationError
+) -> ORJSONResponse:
+    """
+    Returns the validation errors of the request serialized with
+    orjson instead of the standard library json encoder used by the
+    default handler.
+
+    Args:
+        request (Request):
+            The incoming request object.
+        exc (RequestValidationError):
+            The raised exception.
+
+    Returns:
+        ORJSONResponse:
+            The error response with the validation errors
+    """
+    return ORJSONResponse(
+        status_code=422, content={"detail": jsonable_encoder(exc.errors())}
+    )
+
+
+@app.middleware("http")
+async def limit_content_length(request: Request, call_next) -> Response:
+    """
+    Rejects the requests whose declared Content-Length exceeds the
+    maximum image file size (plus an allowance for the prompt and the
+    multipart encoding) before their body is received, since the
+    dependencies are only resolved after the body has been parsed.
+    Requests without the header are still checked by the validators.
+
+    Args:
+        request (Request):
+            The incoming request object.
+        call_next (Callable):
+            The next handler of the request.
+
+    Returns:
+        Response:
+            A 413 response if the request body is too large, otherwise
+            the response of the next handler
+    """
+    content_length = request.headers.get("content-length")
+    max_body_size = get_image_settings().max_file_size + _MAX_BODY_OVERHEAD
+    if content_length and content_length.isdigit():
+        if int(content_length) > max_body_size:
+            message = (
+                f"Image too large: request body of {content_length} bytes "
+                f"while maximum allowed size is {max_body_size} bytes"
+            )
+            logger.error(message)
+            return ORJSONResponse(status_code=413, content={"detail": message})
+    return await call_next(request)
+
+
 @app.post(
     "/images/",
     response_model=None,
 )
 async def transform_image(
-    validated_prompt: prompt_validator_dependency,
-    validated_image: image_validator_dependency,
+    request: Request,
+    handler: HandlerDependency,
+    validated_inputs: inputs_validator_dependency,
     num_inference_steps: num_inference_steps_form,
     image_guidance_scale: image_guidance_scale_form,
-) -> StreamingResponse:
+    cache_settings: CacheSettingsDependency,
+    image_settings: ImageSettingsDependency,
+    image_format: image_format_query = AllowedResponseImageFormats.WEBP,
+) -> Response:
     """
     This function handles the POST request to the '/images/' endpoint.
     It transforms an image using a prompt and model parameters, and
-    returns the transformed image.
+    returns the transformed image. The transformed images are cached
+    in Redis, so that the identical requests are served without
+    running the model.
 
     Args:
-        validated_prompt (str):
-            Dependency which reads the prompt and returns the validated
-            prompt.
-        validated_image (Image.Image):
-            Dependency which reads the image and returns the validated
-            image.
+        request (Request):
+            The incoming request object, used to access the shared
+            Redis client stored in the application state.
+        handler (FastAPIHandler):
+            Dependency which returns the FastAPIHandler created once
+            during the application startup.
+        validated_inputs (Tuple[Image.Image, bytes, str]):
+            Dependency which reads the prompt and the image and
+            returns the validated image, the digest of the uploaded
+            image file and the validated prompt.
         num_inference_steps (int):
             Number of inference steps for the model.
         image_guidance_scale (float):
             Image guidance scale for the model.
+        cache_settings (CacheSettings):
+            Cache settings.
+        image_settings (ImageSettings):
+            Image settings.
+        image_format (AllowedResponseImageFormats, default WEBP):
+            Format of the transformed image.
 
     Returns:
-        StreamingResponse:
-            A FastAPI StreamingResponse object containing the processed
-            image
+        Response:
+            A FastAPI Response object containing the processed image
 
     Raises:
         HTTPException:
@@ -142,11 +299,25 @@ async def transform_image(
                 - an unexpected error
     """
 
-    # Initialising the content and handler as global variables
-    global handler
+    # Redis client initialised once during the application startup
+    redis_client = request.app.state.redis_client
+    validated_image, image_digest, validated_prompt = validated_inputs
+    media_type = f"image/{image_format.value}"
 
     # Transformisng the image using prompt
     try:
+        # Returning the cached image if the same request was served
+        cache_key = make_cache_key(
+            image_digest=image_digest,
+            prompt=validated_prompt,
+            num_inference_steps=num_inference_steps,
+            image_guidance_scale=image_guidance_scale,
+            image_format=image_format.value,
+        )
+        content = await get_cached_image(redis_client, cache_key)
+        if content is not None:
+            logger.info("Returning the cached transformed image")
+            return Response(content=content, media_type=media_type)
         # Transforming the image asynchronously using FastAPIHandler
         content = await handler.handle(
             num_inference_steps=num_inference_steps,
@@ -154,11 +325,19 @@ async def transform_image(
             prompt=validated_prompt,
             image=validated_image,
         )
-        content = await pil_image_to_bytes(image=content)
+        content = await pil_image_to_bytes(
+            image=content,
+            format=image_format.value,
+            compress_level=image_settings.png_compress_level,
+        )
         logger.info(f"Image has been successfully transformed")
+        await set_cached_image(
+            redis_client, cache_key, content, ttl=cache_settings.ttl
+        )
         # Returning the transformed image
-        return StreamingResponse(BytesIO(content), media_type="image/png")
-        # return Response(content=content, media_type="image/png")
+        return Response(content=content, media_type=media_type)
+    except HTTPException:
+        raise
     except Exception as e:
         message = f"Unexpected error: {str(e)}"
         logger.error(message)
@@ -1,11 +1,13 @@
 #!/usr/local/bin/python3
 
 from fast_api_project.settings import ModelSettings
-from fast_api_project.utils.loader import download_model
+from fast_api_project.utils.loader import download_model, download_tiny_vae
 
 
 def main():
-    download_model(settings=ModelSettings())
+    settings = ModelSettings()
+    download_model(settings=settings)
+    download_tiny_vae(settings=settings)
 
 
 if __name__ == "__main__":
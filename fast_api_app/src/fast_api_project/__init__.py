@@ -1,10 +1,13 @@
 import os
+import queue
+import atexit
 from pathlib import Path
 
 import yaml
 import coloredlogs
 import logging.config
 from jinja2 import Template
+from logging.handlers import QueueHandler, QueueListener
 from aiologger import Logger
 from jinja2.exceptions import TemplateError
 
@@ -12,6 +15,12 @@ from fast_api_project.config.path_config import path_vars
 from fast_api_project.exceptions import EnvironmentVariableUndefined
 
 
+# Using the libyaml C loader when PyYAML is built with it
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 # Reading config file
 try:
     if os.getenv("CONFIG_PATH") is None:
@@ -23,7 +32,7 @@ try:
             file.read(), undefined=EnvironmentVariableUndefined
         )
     rendered_yaml = template.render(os.environ)
-    config = yaml.safe_load(rendered_yaml)
+    config = yaml.load(rendered_yaml, Loader=YamlLoader)
     coloredlogs.install()
 except FileNotFoundError as e:
     raise FileNotFoundError("Unable to locate the logging configuration file")
@@ -46,3 +55,14 @@ logging.config.dictConfig(config)
 # Create and provide logger instance
 logger = logging.getLogger("fast_api_project")
 # logger = Logger.with_default_handlers(name="fast_api_project")
+
+# Moving the configured handlers behind a queue, so that the console
+# and file writes are done by a background thread instead of the
+# thread emitting the record
+log_listener = QueueListener(
+    queue.SimpleQueue(), *logger.handlers, respect_handler_level=True
+)
+logger.handlers = [QueueHandler(log_listener.queue)]
+log_listener.start()
+# Flushing the queued records on the interpreter exit
+atexit.register(log_listener.stop)
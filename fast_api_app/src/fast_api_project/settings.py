@@ -1,7 +1,7 @@
 from enum import Enum
 from pathlib import Path
 from functools import lru_cache
-from typing import Set, Literal, Annotated
+from typing import Set, List, Tuple, Literal, Annotated
 
 
 from pydantic import Field
@@ -48,6 +48,14 @@ class AllowedPromptFileExtensions(str, Enum):
     TEXT = "txt"
 
 
+class AllowedResponseImageFormats(str, Enum):
+    """Enum for allowed formats of the transformed image."""
+
+    WEBP = "webp"
+    PNG = "png"
+    JPEG = "jpeg"
+
+
 class ImageSettings(BaseSettings):
     """
     Settings for the application, which checks the input image file
@@ -66,6 +74,13 @@ class ImageSettings(BaseSettings):
         max_height (int):
             Image height to which the image will be resized if it is
             larger.
+        allowed_sizes (List[Tuple[int, int]]):
+            Sizes (width, height) supported by the model, to one of
+            which the image is resized before the transformation.
+        png_compress_level (int):
+            zlib compression level (0-9) of the PNG responses.
+        decoded_cache_size (int):
+            Number of the most recently decoded images kept in memory.
     """
 
     max_file_size: int = Field(
@@ -101,6 +116,25 @@ class ImageSettings(BaseSettings):
         ge=512,
         le=1536,
     )
+    allowed_sizes: List[Tuple[int, int]] = Field(
+        config["constraints"]["image"]["allowed_sizes"],
+        description=(
+            "Sizes (width, height) to which the image is resized "
+            "before the transformation"
+        ),
+        min_items=1,
+    )
+    png_compress_level: int = Field(
+        config["constraints"]["image"]["png_compress_level"],
+        description="zlib compression level of the PNG responses",
+        ge=0,
+        le=9,
+    )
+    decoded_cache_size: int = Field(
+        config["constraints"]["image"]["decoded_cache_size"],
+        description="Number of the most recently decoded images kept",
+        ge=0,
+    )
 
 
 class PromptSettings(BaseSettings):
@@ -199,6 +233,22 @@ class ModelSettings(BaseSettings):
             The maximum image guidance scale for the model.
         device (Literal["cuda", "cpu"]):
             The device to use for transformations.
+        taesd_checkpoint (str):
+            The checkpoint of the tiny autoencoder (TAESD).
+        use_taesd (bool):
+            Whether to decode the latents with the tiny autoencoder
+            (TAESD) instead of the full VAE.
+        low_vram (bool):
+            Whether to offload the state dict to disk while loading
+            the model.
+        max_queue_size (int):
+            The maximum number of transformation jobs waiting for the
+            GPU.
+        max_batch_size (int):
+            The maximum number of jobs transformed in one batch.
+        batch_window_ms (int):
+            The time window to collect the jobs of a batch in
+            milliseconds.
     """
 
     hf_model_checkpoint: Literal["timbrooks/instruct-pix2pix"] = Field(
@@ -215,7 +265,7 @@ class ModelSettings(BaseSettings):
         config["constraints"]["model"]["num_inference_steps"]["max"],
         description="Maximum number of inference steps for the model",
         ge=6,
-        le=10,
+        le=8,
     )
     min_image_guidance_scale: float = Field(
         config["constraints"]["model"]["image_guidance_scale"]["min"],
@@ -233,6 +283,77 @@ class ModelSettings(BaseSettings):
         config["model_config"]["device"],
         description="Device to use for transformations",
     )
+    taesd_checkpoint: Literal["madebyollin/taesd"] = Field(
+        config["model_config"]["taesd_checkpoint"],
+        description="Checkpoint of the tiny autoencoder (TAESD)",
+    )
+    use_taesd: bool = Field(
+        config["model_config"]["use_taesd"],
+        description="Whether to use the tiny autoencoder (TAESD)",
+    )
+    low_vram: bool = Field(
+        config["model_config"]["low_vram"],
+        description="Whether to offload the state dict while loading",
+    )
+    max_queue_size: int = Field(
+        config["model_config"]["max_queue_size"],
+        description="Maximum number of jobs waiting for the GPU",
+        ge=1,
+        le=64,
+    )
+    max_batch_size: int = Field(
+        config["model_config"]["max_batch_size"],
+        description="Maximum number of jobs transformed in one batch",
+        ge=1,
+        le=16,
+    )
+    batch_window_ms: int = Field(
+        config["model_config"]["batch_window_ms"],
+        description="Time window to collect the jobs of a batch in ms",
+        ge=0,
+        le=1000,
+    )
+
+
+class CacheSettings(BaseSettings):
+    """
+    Settings for caching of the transformed images.
+
+    Attributes:
+        ttl (int):
+            Time to live of the cached images in seconds.
+    """
+
+    ttl: int = Field(
+        config["cache_config"]["ttl"],
+        description="Time to live of the cached images in seconds",
+        ge=1,
+        le=86400,
+    )
+
+
+class RedisSettings(BaseSettings):
+    """
+    Settings for the connection to Redis.
+
+    Attributes:
+        url (str):
+            URL of the Redis server.
+        max_connections (int):
+            Maximum number of connections in the shared connection
+            pool.
+    """
+
+    url: str = Field(
+        config["redis_config"]["url"],
+        description="URL of the Redis server",
+    )
+    max_connections: int = Field(
+        config["redis_config"]["max_connections"],
+        description="Maximum number of connections in the pool",
+        ge=1,
+        le=1024,
+    )
 
 
 @lru_cache
@@ -275,8 +396,25 @@ def get_model_settings() -> ModelSettings:
     return ModelSettings()
 
 
+@lru_cache
+def get_cache_settings() -> CacheSettings:
+    """
+    Returns the cache settings.
+    """
+    return CacheSettings()
+
+
+@lru_cache
+def get_redis_settings() -> RedisSettings:
+    """
+    Returns the Redis settings.
+    """
+    return RedisSettings()
+
+
 ImageSettingsDependency = Annotated[ImageSettings, Depends(get_image_settings)]
 PromptSettingsDependency = Annotated[
     PromptSettings, Depends(get_prompt_settings)
 ]
 ModelSettingsDependency = Annotated[ModelSettings, Depends(get_model_settings)]
+CacheSettingsDependency = Annotated[CacheSettings, Depends(get_cache_settings)]
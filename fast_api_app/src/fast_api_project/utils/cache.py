@@ -0,0 +1,97 @@
+import struct
+import hashlib
+
+import redis.asyncio as aioredis
+
+from fast_api_project import logger
+
+
+def make_cache_key(
+    image_digest: bytes,
+    prompt: str,
+    num_inference_steps: int,
+    image_guidance_scale: float,
+    image_format: str,
+) -> str:
+    """
+    Builds a content-addressed cache key of a transformation request.
+    The image is identified by the digest of the uploaded file, which
+    is computed while decoding it, so that the decoded pixels are not
+    copied and hashed again.
+
+    Args:
+        image_digest (bytes):
+            Digest of the uploaded image file
+        prompt (str):
+            Promt to be used for transformations
+        num_inference_steps (int):
+            Number of inference steps
+        image_guidance_scale (float):
+            Image guidance scale
+        image_format (str):
+            Format of the transformed image
+
+    Returns:
+        str:
+            The cache key
+    """
+    digest = hashlib.sha256()
+    # Prefixing the variable-length fields with their lengths, so that
+    # the boundaries between the fields are unambiguous
+    for field in (
+        image_digest,
+        prompt.encode("utf-8"),
+        image_format.encode("utf-8"),
+    ):
+        digest.update(struct.pack("<I", len(field)))
+        digest.update(field)
+    digest.update(
+        struct.pack("<if", num_inference_steps, image_guidance_scale)
+    )
+    return f"images:{digest.hexdigest()}"
+
+
+async def get_cached_image(
+    redis_client: aioredis.Redis, key: str
+) -> bytes | None:
+    """
+    Returns the cached transformed image. Cache errors are logged and
+    treated as a cache miss.
+
+    Args:
+        redis_client (aioredis.Redis):
+            The Redis client
+        key (str):
+            The cache key
+
+    Returns:
+        bytes | None:
+            The cached image as bytes or None if it is not cached
+    """
+    try:
+        return await redis_client.get(key)
+    except aioredis.RedisError as e:
+        logger.warning(f"Unable to read the cached image: {str(e)}")
+        return None
+
+
+async def set_cached_image(
+    redis_client: aioredis.Redis, key: str, content: bytes, ttl: int
+) -> None:
+    """
+    Caches the transformed image. Cache errors are logged and ignored.
+
+    Args:
+        redis_client (aioredis.Redis):
+            The Redis client
+        key (str):
+            The cache key
+        content (bytes):
+            The transformed image as bytes
+        ttl (int):
+            Time to live of the cached image in seconds
+    """
+    try:
+        await redis_client.set(key, content, ex=ttl)
+    except aioredis.RedisError as e:
+        logger.warning(f"Unable to cache the image: {str(e)}")
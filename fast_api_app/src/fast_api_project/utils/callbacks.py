@@ -22,11 +22,12 @@ async def global_callback(
             the request.
     """
     expire = calculate_expire_time(pexpire)
-    message = f"Too Many Overall Requests. Retry after {expire} seconds."
-    logger.warning(message)
+    logger.warning(
+        "Too Many Overall Requests. Retry after %s seconds.", expire
+    )
     raise HTTPException(
         status_code=429,
-        detail=message,
+        detail=f"Too Many Overall Requests. Retry after {expire} seconds.",
         headers={"Retry-After": str(expire)},
     )
 
@@ -49,12 +50,13 @@ async def per_ip_callback(
             the request.
     """
     expire = calculate_expire_time(pexpire)
-    message = (
-        f"Too Many Requests from your IP. " f"Retry after {expire} seconds."
+    logger.warning(
+        "Too Many Requests from your IP. Retry after %s seconds.", expire
     )
-    logger.warning(message)
     raise HTTPException(
         status_code=429,
-        detail=message,
+        detail=(
+            f"Too Many Requests from your IP. Retry after {expire} seconds."
+        ),
         headers={"Retry-After": str(expire)},
     )
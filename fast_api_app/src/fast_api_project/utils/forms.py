@@ -1,8 +1,15 @@
 from typing import Annotated
 
-from fastapi import Form
+from fastapi import Form, Query
 
-from fast_api_project.settings import get_model_settings
+from fast_api_project.settings import (
+    AllowedResponseImageFormats,
+    get_model_settings,
+)
+
+
+# Model settings resolved once for all the form fields
+_model_settings = get_model_settings()
 
 
 # Form field for specifying the number of inference steps
@@ -11,8 +18,8 @@ num_inference_steps_form = Annotated[
     Form(
         title="Number of inference steps",
         description="Number of inference steps for the model",
-        ge=get_model_settings().min_inference_steps,
-        le=get_model_settings().max_inference_steps,
+        ge=_model_settings.min_inference_steps,
+        le=_model_settings.max_inference_steps,
     ),
 ]
 
@@ -22,7 +29,17 @@ image_guidance_scale_form = Annotated[
     Form(
         title="Image guidance scale",
         description="Image guidance scale for the model",
-        ge=get_model_settings().min_image_guidance_scale,
-        le=get_model_settings().max_image_guidance_scale,
+        ge=_model_settings.min_image_guidance_scale,
+        le=_model_settings.max_image_guidance_scale,
+    ),
+]
+
+# Query parameter for specifying the format of the transformed image
+image_format_query = Annotated[
+    AllowedResponseImageFormats,
+    Query(
+        alias="format",
+        title="Image format",
+        description="Format of the transformed image",
     ),
 ]
@@ -1,4 +1,8 @@
-from fastapi import Request
+import math
+import time
+from typing import Awaitable, Callable, Dict
+
+from fastapi import Request, Response
 from fastapi_limiter.depends import RateLimiter
 
 from fast_api_project.settings import (
@@ -11,7 +15,8 @@ from fast_api_project.utils.callbacks import global_callback, per_ip_callback
 async def get_ip_key(request: Request) -> str:
     """
     Extracts and returns the client's IP address from the FastAPI
-    request.
+    request. The address is stored in the request state, so that it is
+    resolved only once per request.
 
     Parameters:
         request (Request):
@@ -22,10 +27,144 @@ async def get_ip_key(request: Request) -> str:
         str:
             The client's IP address as a string.
     """
-    try:
-        return request.client.host
-    except AttributeError:
-        return "unknown"
+    client_ip = getattr(request.state, "client_ip", None)
+    if client_ip is None:
+        client_ip = request.client.host if request.client else "unknown"
+        request.state.client_ip = client_ip
+    return client_ip
+
+
+class LocalRateLimiter:
+    """
+    In-process cache of the rejections of a Redis-backed limiter, used
+    as a pre-check before it. fastapi-limiter counts the requests in a
+    fixed window, which starts at the first request and ends when its
+    key expires, and does not count the rejected requests. Once Redis
+    rejects a request, it rejects every request with the same key
+    until the returned PTTL runs out, so the worker rejects them
+    locally for that time, without any Redis round trip. A request is
+    therefore only rejected locally if Redis would reject it as well.
+
+    Attributes:
+        identifier (Callable[[Request], Awaitable[str]]):
+            Function returning the identifier of the request.
+        callback (Callable[[Request, Response, int], Awaitable[None]]):
+            Function called when the request is rejected.
+        max_identifiers (int):
+            Number of tracked identifiers above which the expired
+            ones are dropped.
+    """
+
+    def __init__(
+        self,
+        identifier: Callable[[Request], Awaitable[str]],
+        callback: Callable[[Request, Response, int], Awaitable[None]],
+        max_identifiers: int = 10000,
+    ):
+        """
+        Initializes the LocalRateLimiter class.
+
+        Args:
+            identifier (Callable[[Request], Awaitable[str]]):
+                Function returning the identifier of the request.
+            callback (Callable[[Request, Response, int], Awaitable[None]]):
+                Function called when the request is rejected.
+            max_identifiers (int, default 10000):
+                Number of tracked identifiers above which the expired
+                ones are dropped.
+        """
+        self.identifier = identifier
+        self.callback = callback
+        self.max_identifiers = max_identifiers
+        self._blocked_until: Dict[str, float] = {}
+
+    async def _get_key(self, request: Request) -> str:
+        """
+        Returns the key of the request, which matches the scope of the
+        Redis key: the identifier, the method and the path.
+
+        Args:
+            request (Request):
+                The incoming request object.
+
+        Returns:
+            str:
+                The key of the request
+        """
+        identifier = await self.identifier(request)
+        return f"{identifier}:{request.method}:{request.scope['path']}"
+
+    def _drop_expired(self, now: float) -> None:
+        """
+        Drops the keys whose rejection period has passed.
+
+        Args:
+            now (float):
+                Current time in milliseconds.
+        """
+        self._blocked_until = {
+            key: blocked_until
+            for key, blocked_until in self._blocked_until.items()
+            if blocked_until > now
+        }
+
+    def caching(
+        self, callback: Callable[[Request, Response, int], Awaitable[None]]
+    ) -> Callable[[Request, Response, int], Awaitable[None]]:
+        """
+        Wraps the callback of the Redis-backed limiter, so that its
+        rejections are cached before the callback is called. The
+        rejection period is counted from the time of the local check,
+        which precedes the Redis check, so that it never outlasts the
+        Redis window.
+
+        Args:
+            callback (Callable[[Request, Response, int], Awaitable[None]]):
+                The callback of the Redis-backed limiter.
+
+        Returns:
+            Callable[[Request, Response, int], Awaitable[None]]:
+                The wrapped callback
+        """
+
+        async def caching_callback(
+            request: Request, response: Response, pexpire: int
+        ) -> None:
+            if pexpire > 0:
+                now = time.monotonic() * 1000
+                checked_at = getattr(request.state, "rate_limit_time", now)
+                if len(self._blocked_until) > self.max_identifiers:
+                    self._drop_expired(now)
+                key = await self._get_key(request)
+                self._blocked_until[key] = checked_at + pexpire
+            return await callback(request, response, pexpire)
+
+        return caching_callback
+
+    async def __call__(self, request: Request, response: Response) -> None:
+        """
+        Rejects the request by calling the callback if Redis has
+        rejected a request with the same key and its window has not
+        expired yet.
+
+        Args:
+            request (Request):
+                The incoming request object.
+            response (Response):
+                The outgoing response object.
+        """
+        key = await self._get_key(request)
+        now = time.monotonic() * 1000
+        request.state.rate_limit_time = now
+        # There is no await between reading and updating the entry, so
+        # the check is atomic within the event loop without a lock
+        blocked_until = self._blocked_until.get(key)
+        if blocked_until is None:
+            return
+        if now >= blocked_until:
+            del self._blocked_until[key]
+            return
+        await self.callback(request, response, math.ceil(blocked_until - now))
 
 
 # Rate limiter for global requests
@@ -34,9 +173,16 @@ global_limiter = RateLimiter(
     callback=global_callback,
 )
 
+# In-process pre-check of the rate limit per IP address, rejecting
+# the requests already rejected by Redis until their window expires
+local_ip_limiter = LocalRateLimiter(
+    identifier=get_ip_key,
+    callback=per_ip_callback,
+)
+
 # Rate limiter for requests per IP address
 ip_limiter = RateLimiter(
     **dict(get_ip_request_rate_limit_settings()),
     identifier=get_ip_key,
-    callback=per_ip_callback,
+    callback=local_ip_limiter.caching(per_ip_callback),
 )
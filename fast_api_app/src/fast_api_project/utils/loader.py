@@ -1,15 +1,20 @@
+from pathlib import Path
 from typing import Generator
 
 import torch
 from transformers import HTTPError
 from contextlib import contextmanager
-from diffusers import StableDiffusionInstructPix2PixPipeline
+from diffusers import AutoencoderTiny, StableDiffusionInstructPix2PixPipeline
 
 from fast_api_project import logger
 from fast_api_project.settings import ModelSettings
 from fast_api_project.config.path_config import path_vars
 
 
+# Subfolder of the model directory with the tiny autoencoder (TAESD)
+TINY_VAE_SUBFOLDER = "taesd"
+
+
 @contextmanager
 def model_context(
     settings: ModelSettings,
@@ -41,8 +46,8 @@ def model_context(
             pretrained_model_name_or_path=settings.hf_model_checkpoint,
             torch_dtype=torch.float16,
             safety_checker=None,
-            offload_folder="offload",
-            offload_state_dict=True,
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
             cache_dir=path_vars.model_path,
             local_files_only=False,
         )
@@ -86,7 +91,11 @@ def download_model(settings: ModelSettings) -> None:
             logger.info(
                 "Model loaded successfully, saving it to local directory"
             )
-            model.save_pretrained(path_vars.model_path)
+            # Saving the weights as safetensors, so that they are
+            # memory-mapped when the application loads the model
+            model.save_pretrained(
+                path_vars.model_path, safe_serialization=True
+            )
             logger.info("Model saved successfully")
     except OSError as e:
         logger.error(f"Error saving model locally: {str(e)}")
@@ -97,3 +106,44 @@ def download_model(settings: ModelSettings) -> None:
             f"save: {str(e)}"
         )
         raise
+
+
+def download_tiny_vae(settings: ModelSettings) -> None:
+    """
+    Downloads the tiny autoencoder (TAESD) from the Hugging Face Hub
+    and saves it to the subfolder of the model directory, so that the
+    application loads it from the local files like the model.
+
+    Args:
+        settings (ModelSettings):
+            The model settings for the application.
+
+    Raises:
+        OSError:
+            If there is an error downloading or saving the tiny
+            autoencoder.
+        Exception:
+            If there is an unexpected error during the download and
+            save process.
+    """
+    logger.info("Starting tiny autoencoder download process")
+    try:
+        tiny_vae = AutoencoderTiny.from_pretrained(
+            settings.taesd_checkpoint,
+            torch_dtype=torch.float16,
+            cache_dir=path_vars.model_path,
+        )
+        tiny_vae.save_pretrained(
+            Path(path_vars.model_path) / TINY_VAE_SUBFOLDER,
+            safe_serialization=True,
+        )
+        logger.info("Tiny autoencoder saved successfully")
+    except OSError as e:
+        logger.error(f"Error saving tiny autoencoder locally: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(
+            f"An unexpected error occurred during tiny autoencoder "
+            f"download and save: {str(e)}"
+        )
+        raise
@@ -1,5 +1,5 @@
 import re
-from typing import Annotated
+from typing import Annotated, Tuple
 
 from PIL import Image
 from fastapi import UploadFile, HTTPException, Depends
@@ -16,14 +16,24 @@ from fast_api_project.utils.common import (
 )
 
 
+# Characters considered unsafe in prompts
+_UNSAFE_CHARS = "<>&;"
+
+# Pattern matching any of the unsafe characters
+_UNSAFE_CHARS_RE = re.compile(f"[{re.escape(_UNSAFE_CHARS)}]")
+
+# Translation table removing the unsafe characters
+_SANITIZE_TRANS = str.maketrans("", "", _UNSAFE_CHARS)
+
+
 async def validate_image(
     image: UploadFile, settings: ImageSettingsDependency
-) -> Image.Image:
+) -> Tuple[Image.Image, bytes]:
     """
     Validates the uploaded image based on its content type and size and
-    returns the image if it is valid. In case of bigger image (in terms
-    of width and height) it is downscaled to the maximum width and
-    height.
+    returns the image if it is valid, together with the digest of the
+    uploaded file. In case of bigger image (in terms of width and
+    height) it is downscaled to the maximum width and height.
 
     Args:
         image (UploadFile):
@@ -32,8 +42,8 @@ async def validate_image(
             The image settings for the application.
 
     Returns:
-        Image.Image:
-            The validated image
+        Tuple[Image.Image, bytes]:
+            The validated image and the digest of the uploaded file
 
     Raises:
         HTTPException:
@@ -57,11 +67,9 @@ async def validate_image(
         logger.error(message)
         raise HTTPException(status_code=400, detail=message)
 
-    # Check if the prompt file extension is in the allowed extensions
-    if (
-        image.filename.split(".")[-1].lower()
-        not in settings.allowed_file_extensions
-    ):
+    # Check if the image file extension is in the allowed extensions
+    extension = image.filename.rpartition(".")[2].lower()
+    if extension not in settings.allowed_file_extensions:
         message = (
             f"Invalid image file extension: {image.filename} "
             f"while allowed extensions are "
@@ -77,18 +85,18 @@ async def validate_image(
             f"maximum allowed image size is {settings.max_file_size} bytes"
         )
         logger.error(message)
-        raise HTTPException(status_code=400, detail=message)
+        raise HTTPException(status_code=413, detail=message)
 
-    # Reading the image
-    content = await read_upload_file(image)
-
-    # Converting the image bytes to a PIL image
-    content = await bytes_to_pil_image(image=content)
-
-    # Reducing the size of the image to the maximum size
-    content.thumbnail((settings.max_width, settings.max_height))
-
-    return content
+    # Converting the uploaded file to a PIL image reduced to the maximum
+    # size. The decoder reads the spooled file directly, without
+    # copying its whole content into memory first
+    await image.seek(0)
+    return await bytes_to_pil_image(
+        image=image.file,
+        max_width=settings.max_width,
+        max_height=settings.max_height,
+        cache_size=settings.decoded_cache_size,
+    )
 
 
 async def validate_prompt(
@@ -129,10 +137,8 @@ async def validate_prompt(
         raise HTTPException(status_code=400, detail=message)
 
     # Check if the prompt file extension is in the allowed extensions
-    if (
-        not prompt.filename.split(".")[-1].lower()
-        in settings.allowed_file_extensions
-    ):
+    extension = prompt.filename.rpartition(".")[2].lower()
+    if extension not in settings.allowed_file_extensions:
         message = (
             f"Invalid prompt file extension: {prompt.filename} "
             f"while allowed extensions are "
@@ -148,34 +154,69 @@ async def validate_prompt(
     prompt_text = decode_bytes_to_str(byte_data=prompt_content)
     prompt_text = prompt_text.strip()
 
-    # Sanitize the prompt
-    sanitized_prompt = re.sub(r"[<>&;]", "", prompt_text)
+    # Check if the prompt contains unsafe characters. The scan stops at
+    # the first unsafe character and the sanitized prompt is only built
+    # for the log message of the rejected prompt
+    if _UNSAFE_CHARS_RE.search(prompt_text):
+        message = (
+            f"Prompt was sanitized. Original: '{prompt_text}', "
+            f"Sanitized: '{prompt_text.translate(_SANITIZE_TRANS)}'"
+        )
+        logger.warning(message)
+        raise HTTPException(
+            status_code=400,
+            detail="Unsafe prompt. Avoid using special characters",
+        )
 
     # Check if the prompt is too long
-    if len(sanitized_prompt) > settings.max_prompt_length:
+    if len(prompt_text) > settings.max_prompt_length:
         message = (
-            f"Prompt too long: {len(sanitized_prompt)} characters "
+            f"Prompt too long: {len(prompt_text)} characters "
             f"while the maximum allowed length is "
             f"{settings.max_prompt_length} characters"
         )
         logger.error(message)
         raise HTTPException(status_code=400, detail=message)
 
-    # Check if the prompt was modified during sanitization
-    if sanitized_prompt != prompt_text:
-        message = (
-            f"Prompt was sanitized. Original: '{prompt_text}', "
-            f"Sanitized: '{sanitized_prompt}'"
-        )
-        logger.warning(message)
-        raise HTTPException(
-            status_code=400,
-            detail="Unsafe prompt. Avoid using special characters",
-        )
+    return prompt_text
+
+
+async def validate_inputs(
+    image: UploadFile,
+    prompt: UploadFile,
+    image_settings: ImageSettingsDependency,
+    prompt_settings: PromptSettingsDependency,
+) -> Tuple[Image.Image, bytes, str]:
+    """
+    Validates the input prompt and then the uploaded image. The prompt
+    is validated first, since its checks are cheap, so that the image
+    is not decoded for a request with an invalid prompt.
+
+    Args:
+        image (UploadFile):
+            The uploaded image to be validated.
+        prompt (UploadFile):
+            The input prompt file to be validated and sanitized.
+        image_settings (ImageSettings):
+            The image settings for the application.
+        prompt_settings (PromptSettings):
+            The prompt settings for the application.
 
-    return sanitized_prompt
+    Returns:
+        Tuple[Image.Image, bytes, str]:
+            The validated image, the digest of the uploaded image file
+            and the sanitized prompt
+
+    Raises:
+        HTTPException:
+            The error raised by the prompt or the image validator
+    """
+    validated_prompt = await validate_prompt(prompt, prompt_settings)
+    validated_image, digest = await validate_image(image, image_settings)
+    return validated_image, digest, validated_prompt
 
 
-# Defining the dependencies for the validators
-prompt_validator_dependency = Annotated[str, Depends(validate_prompt)]
-image_validator_dependency = Annotated[Image.Image, Depends(validate_image)]
+# Defining the dependency for the validators
+inputs_validator_dependency = Annotated[
+    Tuple[Image.Image, bytes, str], Depends(validate_inputs)
+]
@@ -1,20 +1,33 @@
 #!/usr/local/bin/python3
 
 import io
+import json
 import sys
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))
 
 import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
 from PIL import Image
-from fastapi import Response
+from fastapi import HTTPException, Response
 from fastapi.testclient import TestClient
 
-from app.main import app
+from app.main import app, limit_content_length, _MAX_BODY_OVERHEAD
 from fast_api_project.config.path_config import path_vars
-from fast_api_project.utils.common import read_yaml, get_response
-from fast_api_project.utils.limiters import global_limiter, ip_limiter
+from fast_api_project.fast_api_handler import FastAPIHandler
+from fast_api_project.utils import common
+from fast_api_project.utils.common import read_yaml, get_response, http_errors
+from fast_api_project.utils.limiters import (
+    LocalRateLimiter,
+    global_limiter,
+    ip_limiter,
+    local_ip_limiter,
+)
+from fast_api_project.utils.callbacks import per_ip_callback
+from fast_api_project.settings import get_image_settings
+from fast_api_project.utils.cache import make_cache_key
 
 
 class TestFastAPIApp(unittest.TestCase):
@@ -30,10 +43,12 @@ class TestFastAPIApp(unittest.TestCase):
     def setUp(self):
         """
         Sets up the test environment by overriding the global and IP
-        limiters, and loads the invalid test cases from a YAML file.
+        limiters (including the local IP pre-check), and loads the
+        invalid test cases from a YAML file.
         """
         app.dependency_overrides[global_limiter] = lambda: None
         app.dependency_overrides[ip_limiter] = lambda: None
+        app.dependency_overrides[local_ip_limiter] = lambda: None
         self.invalid_tests = read_yaml(
             Path(f"{path_vars.app_root_path}/tests/invalid_tests.yaml")
         )
@@ -44,21 +59,33 @@ class TestFastAPIApp(unittest.TestCase):
         """
         app.dependency_overrides.clear()
 
-    def _test_valid(self, client: TestClient) -> None:
+    def _test_valid(
+        self,
+        client: TestClient,
+        image_format: str | None = None,
+        expected_format: str = "WEBP",
+    ) -> None:
         """
         Test a valid response from the FastAPI application.
 
         Args:
             client (TestClient):
                 The FastAPI test client instance.
+            image_format (str | None, default None):
+                The format of the transformed image to request.
+            expected_format (str, default "WEBP"):
+                The expected PIL format of the transformed image.
         """
-        response = get_response(client=client)
+        response = get_response(client=client, image_format=image_format)
         # Check if the response is valid
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.headers["content-type"], "image/png")
-        # Check if the response content is a valid PNG image
+        self.assertEqual(
+            response.headers["content-type"],
+            f"image/{expected_format.lower()}",
+        )
+        # Check if the response content is a valid image
         image = Image.open(io.BytesIO(response.content))
-        self.assertEqual(image.format, "PNG")
+        self.assertEqual(image.format, expected_format)
         self.assertEqual(image.mode, "RGB")
 
     def _sub_test_invalid(
@@ -188,10 +215,466 @@ class TestFastAPIApp(unittest.TestCase):
             # Valid test case
             with self.subTest(test_name="valid_test"):
                 self._test_valid(client=client)
+            with self.subTest(test_name="valid_png_test"):
+                self._test_valid(
+                    client=client, image_format="png", expected_format="PNG"
+                )
             # Invalid test cases
             with self.subTest(test_name="invalid_tests"):
                 self._test_invalid(client=client)
 
 
+class FixedWindowCounter:
+    """
+    Reference model of the Lua script of fastapi-limiter: the window
+    starts at the first request and the rejected requests are not
+    counted.
+
+    Attributes:
+        times (int):
+            Maximum number of requests allowed within a window.
+        milliseconds (int):
+            Length of the window in milliseconds.
+        calls (int):
+            Number of the checks made.
+    """
+
+    def __init__(self, times: int, milliseconds: int):
+        """
+        Initializes the FixedWindowCounter class.
+
+        Args:
+            times (int):
+                Maximum number of requests allowed within a window.
+            milliseconds (int):
+                Length of the window in milliseconds.
+        """
+        self.times = times
+        self.milliseconds = milliseconds
+        self.calls = 0
+        self._count = 0
+        self._expires_at = 0
+
+    def check(self, now: int) -> int:
+        """
+        Counts the request and returns 0 if it is allowed, otherwise
+        returns the remaining time of the window in milliseconds.
+
+        Args:
+            now (int):
+                Time of the request in milliseconds.
+
+        Returns:
+            int:
+                0 or the remaining time of the window in milliseconds
+        """
+        self.calls += 1
+        if now >= self._expires_at:
+            self._count = 0
+        if self._count == 0:
+            self._count = 1
+            self._expires_at = now + self.milliseconds
+            return 0
+        if self._count + 1 > self.times:
+            return self._expires_at - now
+        self._count += 1
+        return 0
+
+
+class TestLocalRateLimiter(unittest.IsolatedAsyncioTestCase):
+    """
+    Compares the Redis-backed rate limiter with and without the local
+    pre-check at the window boundaries.
+    """
+
+    async def _identifier(self, request) -> str:
+        """
+        Returns the same identifier for all requests.
+        """
+        return "127.0.0.1"
+
+    async def _is_allowed(
+        self,
+        local_limiter: LocalRateLimiter | None,
+        counter: FixedWindowCounter,
+        now: int,
+    ) -> bool:
+        """
+        Passes a request through the local pre-check and the reference
+        model of the Redis-backed limiter.
+
+        Args:
+            local_limiter (LocalRateLimiter | None):
+                The local pre-check, or None to check with Redis only.
+            counter (FixedWindowCounter):
+                The reference model of the Redis-backed limiter.
+            now (int):
+                Time of the request in milliseconds.
+
+        Returns:
+            bool:
+                Whether the request is allowed
+        """
+        request = SimpleNamespace(
+            method="POST", scope={"path": "/images/"}, state=SimpleNamespace()
+        )
+        callback = per_ip_callback
+        with patch(
+            "fast_api_project.utils.limiters.time.monotonic",
+            return_value=now / 1000,
+        ):
+            try:
+                if local_limiter is not None:
+                    await local_limiter(request, Response())
+                    callback = local_limiter.caching(per_ip_callback)
+                pexpire = counter.check(now)
+                if pexpire != 0:
+                    await callback(request, Response(), pexpire)
+            except HTTPException as exception:
+                self.assertEqual(exception.status_code, 429)
+                return False
+        return True
+
+    async def test_window_boundary(self):
+        """
+        Checks that the local pre-check rejects the same requests as
+        Redis, also right after the window of Redis has expired, and
+        that it rejects them without a Redis round trip.
+        """
+        timestamps = [
+            0, 59000, 59000, 59000, 59500, 60100,
+            61000, 61000, 61000, 61500, 120000, 120200,
+        ]  # fmt: skip
+        expected = [
+            True, True, True, True, False, True,
+            True, True, True, False, False, True,
+        ]  # fmt: skip
+        local_limiter = LocalRateLimiter(
+            identifier=self._identifier, callback=per_ip_callback
+        )
+        redis_only = FixedWindowCounter(times=4, milliseconds=60000)
+        with_local = FixedWindowCounter(times=4, milliseconds=60000)
+        for now, allowed in zip(timestamps, expected):
+            with self.subTest(now=now):
+                self.assertEqual(
+                    await self._is_allowed(None, redis_only, now), allowed
+                )
+                self.assertEqual(
+                    await self._is_allowed(local_limiter, with_local, now),
+                    allowed,
+                )
+        # The request at 120000 was rejected without a Redis round trip
+        self.assertEqual(with_local.calls, redis_only.calls - 1)
+
+
+class TestDecodedImageCache(unittest.TestCase):
+    """
+    Test suite for the cache of the decoded images.
+    """
+
+    def setUp(self):
+        """
+        Clears the cache of the decoded images.
+        """
+        common._DECODED_IMAGES.clear()
+
+    def tearDown(self):
+        """
+        Clears the cache of the decoded images.
+        """
+        common._DECODED_IMAGES.clear()
+
+    def _encode(self, color: str) -> bytes:
+        """
+        Returns a small PNG image of the given color as bytes.
+
+        Args:
+            color (str):
+                Color of the image
+
+        Returns:
+            bytes:
+                The encoded image
+        """
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 48), color).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def _decode(self, image: bytes, cache_size: int = 2):
+        """
+        Decodes the image through the cache.
+
+        Args:
+            image (bytes):
+                The encoded image
+            cache_size (int, default 2):
+                Maximum number of cached images
+
+        Returns:
+            Tuple[Image.Image, bytes]:
+                The decoded image and the digest of the content
+        """
+        return common._decode_and_resize_cached(
+            image, max_width=512, max_height=512, cache_size=cache_size
+        )
+
+    def test_hit(self):
+        """
+        Checks that the same content is decoded only once.
+        """
+        image = self._encode("red")
+        with patch.object(
+            common, "_decode_and_resize", wraps=common._decode_and_resize
+        ) as decode:
+            first, first_digest = self._decode(image)
+            second, second_digest = self._decode(io.BytesIO(image))
+        self.assertEqual(decode.call_count, 1)
+        self.assertEqual(first_digest, second_digest)
+        self.assertEqual(first.tobytes(), second.tobytes())
+
+    def test_eviction(self):
+        """
+        Checks that the least recently used image is evicted.
+        """
+        red, green = self._encode("red"), self._encode("green")
+        with patch.object(
+            common, "_decode_and_resize", wraps=common._decode_and_resize
+        ) as decode:
+            self._decode(red, cache_size=1)
+            self._decode(green, cache_size=1)
+            self._decode(red, cache_size=1)
+        self.assertEqual(decode.call_count, 3)
+        self.assertEqual(len(common._DECODED_IMAGES), 1)
+
+    def test_returned_copy(self):
+        """
+        Checks that modifying the returned image does not modify the
+        cached one.
+        """
+        image = self._encode("red")
+        first, _ = self._decode(image)
+        first.putpixel((0, 0), (0, 0, 255))
+        second, _ = self._decode(image)
+        self.assertIsNot(first, second)
+        self.assertEqual(second.getpixel((0, 0)), (255, 0, 0))
+
+
+class TestHttpErrors(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the decorator mapping the exceptions to HTTP errors.
+    """
+
+    mapping = {
+        KeyError: (404, "Missing key"),
+        LookupError: (400, "Invalid lookup"),
+    }
+
+    def _raising(self, error: Exception):
+        """
+        Returns a sync and an async function raising the given error,
+        both decorated with the mapping.
+
+        Args:
+            error (Exception):
+                The error to be raised
+
+        Returns:
+            Tuple[Callable, Callable]:
+                The sync and the async function
+        """
+
+        @http_errors(self.mapping)
+        def sync_func():
+            raise error
+
+        @http_errors(self.mapping)
+        async def async_func():
+            raise error
+
+        return sync_func, async_func
+
+    async def _assert_raises(self, error: Exception, expected: type):
+        """
+        Checks that both functions raise the expected exception type
+        and returns the exceptions raised.
+
+        Args:
+            error (Exception):
+                The error raised by the functions
+            expected (type):
+                The expected exception type
+
+        Returns:
+            List[Exception]:
+                The exceptions raised by the sync and the async function
+        """
+        sync_func, async_func = self._raising(error)
+        with self.assertRaises(expected) as sync_context:
+            sync_func()
+        with self.assertRaises(expected) as async_context:
+            await async_func()
+        return [sync_context.exception, async_context.exception]
+
+    async def test_exact_type(self):
+        """
+        Checks that the exact exception type is mapped.
+        """
+        for exception in await self._assert_raises(KeyError(), HTTPException):
+            self.assertEqual(exception.status_code, 404)
+            self.assertEqual(exception.detail, "Missing key")
+
+    async def test_base_class(self):
+        """
+        Checks that the subclasses fall back to the mapped base class.
+        """
+        exceptions = await self._assert_raises(IndexError(), HTTPException)
+        for exception in exceptions:
+            self.assertEqual(exception.status_code, 400)
+            self.assertIsInstance(exception.__cause__, IndexError)
+
+    async def test_http_exception(self):
+        """
+        Checks that HTTPException is propagated unchanged.
+        """
+        error = HTTPException(status_code=418)
+        for exception in await self._assert_raises(error, HTTPException):
+            self.assertIs(exception, error)
+
+    async def test_unmapped(self):
+        """
+        Checks that the unmapped exceptions are propagated unchanged.
+        """
+        await self._assert_raises(ValueError(), ValueError)
+
+
+class TestMakeCacheKey(unittest.TestCase):
+    """
+    Test suite for the cache keys of the transformation requests.
+    """
+
+    kwargs = dict(
+        image_digest=b"\x00" * 16,
+        prompt="make it snowy",
+        num_inference_steps=6,
+        image_guidance_scale=1.5,
+        image_format="webp",
+    )
+
+    def test_deterministic(self):
+        """
+        Checks that the same request gets the same key.
+        """
+        key = make_cache_key(**self.kwargs)
+        self.assertTrue(key.startswith("images:"))
+        self.assertEqual(key, make_cache_key(**self.kwargs))
+
+    def test_fields(self):
+        """
+        Checks that changing any of the fields changes the key.
+        """
+        key = make_cache_key(**self.kwargs)
+        for name, value in [
+            ("image_digest", b"\x01" * 16),
+            ("prompt", "make it rainy"),
+            ("num_inference_steps", 7),
+            ("image_guidance_scale", 2.0),
+            ("image_format", "png"),
+        ]:
+            with self.subTest(field=name):
+                changed = make_cache_key(**{**self.kwargs, name: value})
+                self.assertNotEqual(key, changed)
+
+    def test_field_boundaries(self):
+        """
+        Checks that moving characters between the prompt and the format
+        changes the key.
+        """
+        first = {**self.kwargs, "prompt": "ab", "image_format": "cpng"}
+        second = {**self.kwargs, "prompt": "abc", "image_format": "png"}
+        self.assertNotEqual(make_cache_key(**first), make_cache_key(**second))
+
+
+class TestAllowedSize(unittest.TestCase):
+    """
+    Test suite for the choice of the allowed size of the input images.
+    """
+
+    def setUp(self):
+        """
+        Creates a handler with the allowed sizes, without loading the
+        model.
+        """
+        self.handler = FastAPIHandler.__new__(FastAPIHandler)
+        self.handler.image_settings = SimpleNamespace(
+            allowed_sizes=[(512, 512), (512, 768), (768, 512), (768, 768)]
+        )
+
+    def test_allowed_size(self):
+        """
+        Checks that the size with the closest aspect ratio is chosen,
+        then the one with the closest area.
+        """
+        for size, expected in [
+            ((512, 768), (512, 768)),
+            ((300, 300), (512, 512)),
+            ((1000, 1000), (768, 768)),
+            ((600, 900), (512, 768)),
+            ((1200, 800), (768, 512)),
+            ((700, 650), (768, 768)),
+        ]:
+            with self.subTest(size=size):
+                self.assertEqual(self.handler._allowed_size(size), expected)
+
+
+class TestLimitContentLength(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the middleware rejecting the oversized requests.
+    """
+
+    async def _call(self, headers: dict) -> Response:
+        """
+        Passes a request with the given headers through the middleware.
+
+        Args:
+            headers (dict):
+                Headers of the request
+
+        Returns:
+            Response:
+                The response of the middleware
+        """
+
+        async def call_next(request):
+            return Response(status_code=200)
+
+        return await limit_content_length(
+            SimpleNamespace(headers=headers), call_next
+        )
+
+    async def test_oversized(self):
+        """
+        Checks that the requests above the limit are rejected with 413.
+        """
+        max_body_size = get_image_settings().max_file_size + _MAX_BODY_OVERHEAD
+        response = await self._call({"content-length": str(max_body_size + 1)})
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("Image too large", json.loads(response.body)["detail"])
+
+    async def test_passed(self):
+        """
+        Checks that the requests within the limit and the ones without
+        a valid Content-Length are passed on.
+        """
+        max_body_size = get_image_settings().max_file_size + _MAX_BODY_OVERHEAD
+        for headers in [
+            {"content-length": str(max_body_size)},
+            {"content-length": "invalid"},
+            {},
+        ]:
+            with self.subTest(headers=headers):
+                response = await self._call(headers)
+                self.assertEqual(response.status_code, 200)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -15,7 +15,7 @@ def transform_image():
     if request.method == "GET":
         form_data = {
             "prompt": "",
-            "num_inference_steps": "10",
+            "num_inference_steps": "8",
             "image_guidance_scale": "1",
         }
         return render_template(TEMPLATE_NAME, form_data=form_data)
@@ -11,6 +11,12 @@ from frontend_app.config.path_config import path_vars
 from frontend_app.exceptions import EnvironmentVariableUndefined
 
 
+# Using the libyaml C loader when PyYAML is built with it
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 # Reading config file
 try:
     if os.getenv("CONFIG_PATH") is None:
@@ -22,7 +28,7 @@ try:
             file.read(), undefined=EnvironmentVariableUndefined
         )
     rendered_yaml = template.render(os.environ)
-    config = yaml.safe_load(rendered_yaml)
+    config = yaml.load(rendered_yaml, Loader=YamlLoader)
     coloredlogs.install()
 except FileNotFoundError as e:
     raise FileNotFoundError("Unable to locate the logging configuration file")
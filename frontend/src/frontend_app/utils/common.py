@@ -1,16 +1,85 @@
-import io
+import os
+import hashlib
 from typing import Tuple
-from base64 import b64encode
 
 import flask
 import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.datastructures import FileStorage
 
 from frontend_app.config.path_config import path_vars
 
 
+# Session shared by the requests to the FastAPI endpoint, so that the
+# connections are kept alive and reused
+_SESSION = requests.Session()
+_SESSION.mount(
+    "http://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=0)
+)
+
+# Timeout of the requests to the FastAPI endpoint (in seconds)
+_REQUEST_TIMEOUT = 60
+
+# Directory of the static folder with the images shown on the page
+_IMAGE_CACHE_DIR = path_vars.static_path / "cache"
+_IMAGE_CACHE_DIR.mkdir(exist_ok=True)
+
+# Maximum number of images kept in the directory
+_IMAGE_CACHE_SIZE = 256
+
+
+def cache_image(content: bytes, content_type: str) -> str:
+    """
+    Saves the image to the static cache directory under the name
+    derived from its content hash and returns its URL, so that the
+    image is served as a static file which the browser can cache
+    instead of being embedded into the page. The least recently used
+    images are removed when the directory holds more than
+    `_IMAGE_CACHE_SIZE` images.
+
+    Args:
+        content (bytes):
+            The image content.
+        content_type (str):
+            The MIME type of the image, e.g. 'image/png'.
+
+    Returns:
+        str:
+            The URL of the saved image.
+    """
+    extension = content_type.partition("/")[2].partition(";")[0].strip()
+    digest = hashlib.blake2b(content, digest_size=12).hexdigest()
+    path = _IMAGE_CACHE_DIR / f"{digest}.{extension}"
+    if path.exists():
+        # Marking the image as recently used
+        os.utime(path)
+    else:
+        with open(path, "wb") as file:
+            file.write(content)
+        _prune_image_cache()
+    return flask.url_for("static", filename=f"cache/{path.name}")
+
+
+def _prune_image_cache() -> None:
+    """
+    Removes the least recently used images from the static cache
+    directory, so that it holds at most `_IMAGE_CACHE_SIZE` images.
+    """
+    entries = list(os.scandir(_IMAGE_CACHE_DIR))
+    if len(entries) <= _IMAGE_CACHE_SIZE:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[: len(entries) - _IMAGE_CACHE_SIZE]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            # Already removed by a concurrent request
+            pass
+
+
 def get_response(
     request: flask.Request,
-) -> Tuple[requests.Response, io.BytesIO, dict]:
+) -> Tuple[requests.Response, FileStorage, dict]:
     """
     Sends a request to the FastAPI endpoint with the provided image,
     prompt, and model parameters, and returns the response, the
@@ -21,9 +90,9 @@ def get_response(
             The Flask request object containing the form and file data.
 
     Returns:
-        Tuple[requests.Response, io.BytesIO, dict]:
+        Tuple[requests.Response, FileStorage, dict]:
             - The response from the FastAPI endpoint
-            - The original image stored in RAM.
+            - The uploaded original image.
             - The form data submitted in the request.
     """
 
@@ -39,45 +108,44 @@ def get_response(
         "image_guidance_scale": image_guidance_scale,
     }
 
-    # Save and read the original image into memory
-    original_image = io.BytesIO()
-    file.save(original_image)
-    original_image.seek(0)
-
     # Prepare the form data and file data for the request
     data = {
         "num_inference_steps": int(num_inference_steps),
         "image_guidance_scale": float(image_guidance_scale),
     }
     files = {
-        "image": (file.filename, original_image, file.content_type),
+        "image": (file.filename, file.stream, file.content_type),
         "prompt": ("prompt.txt", prompt, "text/plain"),
     }
 
     # Send the POST request to the FastAPI endpoint with
     # the form and file data
-    response = requests.post(
-        path_vars.fast_api_endpoint, files=files, data=data
+    response = _SESSION.post(
+        path_vars.fast_api_endpoint,
+        files=files,
+        data=data,
+        timeout=_REQUEST_TIMEOUT,
     )
-    return response, original_image, form_data
+    return response, file, form_data
 
 
 def render_response(
     response: requests.Response,
-    original_image: io.BytesIO,
+    original_image: FileStorage,
     template_name: str,
     form_data: dict,
 ) -> flask.Response:
     """
     Renders the response from a request, saving the original and
-    transformed images to the file system and returning a rendered
-    template with the image URLs.
+    transformed images to the static cache directory and returning a
+    rendered template with the image URLs.
 
     Args:
         response (requests.Response):
             The response object from the request.
-        original_image (io.BytesIO):
-            The original image stored in RAM.
+        original_image (FileStorage):
+            The uploaded original image, which is only read if the
+            request was successful.
         template_name (str):
             The name of the template to render.
         form_data (dict):
@@ -90,18 +158,16 @@ def render_response(
     # Check if the request was successful
     if response.status_code == 200:
 
-        # Save and read the transformed image into memory
-        transformed_image = io.BytesIO(response.content)
-        transformed_image.seek(0)
+        # Reading the original image, which has been consumed by the
+        # request, from the beginning
+        original_image.stream.seek(0)
 
-        # Forming the URLs for the original and transformed images
-        original_image_url = (
-            f"data:image/png;base64,"
-            f"{b64encode(original_image.getvalue()).decode('utf-8')}"
+        # Saving the original and transformed images as static files
+        original_image_url = cache_image(
+            original_image.stream.read(), original_image.content_type
         )
-        transformed_image_url = (
-            f"data:image/png;base64,"
-            f"{b64encode(transformed_image.getvalue()).decode('utf-8')}"
+        transformed_image_url = cache_image(
+            response.content, response.headers["content-type"]
         )
 
         # Render the template with the images' URLs and the form data